@@ -1,26 +1,51 @@
 #! /usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import contextlib
 import curses
-import functools
+import json
+import os
 import random
 import re
 import requests
-import time
+import sqlite3
+import sys
+import threading
 import webbrowser
 
-from dataclasses import dataclass
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
 from typing import (
     Any,
+    Callable,
+    DefaultDict,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Optional,
+    Set,
     Tuple,
 )
 
 Acks = Dict[str, Dict[str, str]]
 
+# Types of ACKs in the order they are shown. An Acks dict only has entries for
+# the types that have been seen, so look them up with .get(ack_type, {})
+ACK_TYPES = (
+    "ACKs",
+    "Stale ACKs",
+    "NACKs",
+    "Approach ACKs",
+    "Concept ACKs",
+    "Other ACKs",
+)
+
 
-@dataclass
+@dataclass(slots=True)
 class PrInfo:
     number: int
     title: str
@@ -30,15 +55,57 @@ class PrInfo:
     draft: bool
     needs_rebase: bool
     url: str
+    # Strings that each type of filter searches, see apply_filter
+    search_fields: Dict[str, List[str]] = field(init=False, repr=False, compare=False)
+    # Number of ACKs, Stale ACKs, NACKs, and Concept ACKs, see ACK_KEY_FUNCS
+    ack_counts: Tuple[int, int, int, int] = field(init=False, repr=False, compare=False)
+    # Text shown in the table for the labels and each type of ACK
+    labels_joined: str = field(init=False, repr=False, compare=False)
+    acks_joined: Dict[str, str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.search_fields = {
+            "p": [str(self.number)],
+            "t": [self.title],
+            "o": [self.author],
+            "l": self.labels,
+            "a": list(self.acks.get("ACKs", {})),
+            "s": list(self.acks.get("Stale ACKs", {})),
+            "n": list(self.acks.get("NACKs", {})),
+            "c": list(self.acks.get("Concept ACKs", {})),
+        }
+        self.ack_counts = (
+            len(self.acks.get("ACKs", {})),
+            len(self.acks.get("Stale ACKs", {})),
+            len(self.acks.get("NACKs", {})),
+            len(self.acks.get("Concept ACKs", {})),
+        )
+        self.labels_joined = ", ".join(self.labels)
+        self.acks_joined = {}
+        for ack_type in ACK_TYPES:
+            acks = self.acks.get(ack_type, {})
+            self.acks_joined[ack_type] = f"({len(acks)}) " + ", ".join(acks.keys())
 
 
-@dataclass
+@dataclass(slots=True)
 class Filter:
     regex: str = ".*"
     apply: str = "p"
     regular: bool = True
     draft: bool = True
     needs_rebase: bool = True
+    # regex compiled, and the value of regex it was compiled from
+    _compiled: Optional[re.Pattern[str]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _compiled_regex: str = field(default="", init=False, repr=False, compare=False)
+
+    @property
+    def pattern(self) -> re.Pattern[str]:
+        if self._compiled is None or self._compiled_regex != self.regex:
+            self._compiled = re.compile(self.regex, re.IGNORECASE)
+            self._compiled_regex = self.regex
+        return self._compiled
 
     def clear_text_filter(self) -> None:
         self.regex = ".*"
@@ -59,15 +126,44 @@ repo_vars = {
     "repo_owner": "",
 }
 
+# Computed ACKs are cached here between runs, see open_cache
+CACHE_DIR = os.path.expanduser("~/.cache/ackboard")
+# Bump this whenever ACK_PATTERN, extract_acks, or find_acks change which ACKs
+# are found, so that ACKs found by the old code are thrown away
+CACHE_VERSION = 1
+
+# A PR's (head commit, update time) and the ACKs found in it at that point
+CacheEntry = Tuple[Tuple[str, str], Acks]
+
+# Number of requests that can be in flight at once, see fetch_executor
+MAX_WORKERS = 8
+
+# Set when the rate limit is nearly used up to the time that it resets. Requests
+# wait until then before being sent, see graphql_request
+rate_limit_lock = threading.Lock()
+rate_limit_reset: Optional[datetime] = None
+# Set to wake up requests that are waiting when fetching is abandoned
+stop_fetching = threading.Event()
+
+# Shared across the fetch threads so that connections to the API are reused
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
 
 prs_query = """
 query($prs_cursor: String, $repo_owner: String!, $repo_name: String!) {
+  rateLimit {
+    cost
+    remaining
+    resetAt
+  }
   repository(name: $repo_name, owner: $repo_owner) {
     pullRequests(states: [OPEN], first: 100, after: $prs_cursor) {
       nodes {
         number
         isDraft
         headRefOid
+        updatedAt
         title
         url
         author {
@@ -91,8 +187,6 @@ query($prs_cursor: String, $repo_owner: String!, $repo_name: String!) {
           pageInfo {
             endCursor
             hasNextPage
-            hasPreviousPage
-            startCursor
           }
         }
         labels(first: 100) {
@@ -104,19 +198,13 @@ query($prs_cursor: String, $repo_owner: String!, $repo_name: String!) {
       pageInfo {
         endCursor
         hasNextPage
-        hasPreviousPage
-        startCursor
       }
     }
   }
 }
 """
 
-comments_query = """
-    query($comments_cursor: String, $pr_num: Int!, $repo_owner: String!, $repo_name: String!) {
-      repository(name: $repo_name, owner: $repo_owner) {
-        pullRequest(number: $pr_num) {
-          timelineItems(first: 100, after: $comments_cursor, itemTypes: [ISSUE_COMMENT, PULL_REQUEST_REVIEW]) {
+timeline_items_fields = """
             nodes {
               ... on IssueComment{
                 author {
@@ -134,157 +222,447 @@ comments_query = """
             pageInfo {
               endCursor
               hasNextPage
-              hasPreviousPage
-              startCursor
             }
-          }
-        }
-      }
-    }
 """
 
-ACK_PATTERNS = [
-    (re.compile(r"\b(NACK)\b"), "NACKs"),
-    (re.compile(r"(ACK)(?:.*?)([0-9a-f]{6,40})\b"), "ACKs"),
-    (re.compile(r"(ACK)\b"), "Concept ACKs"),
-]
+# Maximum number of PRs whose comments are fetched by a single request
+COMMENTS_BATCH_SIZE = 10
+
+
+# Builds a query fetching the next page of comments for several PRs at once.
+# Each PR gets its own alias (pr0, pr1, ...) and pair of variables.
+def batched_comments_query(num_prs: int) -> str:
+    variables = "".join(
+        f", $comments_cursor{i}: String, $pr_num{i}: Int!" for i in range(num_prs)
+    )
+    prs = "".join(
+        f"""
+        pr{i}: pullRequest(number: $pr_num{i}) {{
+          timelineItems(first: 100, after: $comments_cursor{i}, itemTypes: [ISSUE_COMMENT, PULL_REQUEST_REVIEW]) {{{timeline_items_fields}          }}
+        }}"""
+        for i in range(num_prs)
+    )
+    return f"""
+    query($repo_owner: String!, $repo_name: String!{variables}) {{
+      rateLimit {{
+        cost
+        remaining
+        resetAt
+      }}
+      repository(name: $repo_name, owner: $repo_owner) {{{prs}
+      }}
+    }}
+"""
 
 
-def extract_acks(user: str, text: str, acks: Acks, head_abbrev: str) -> None:
-    for line in text.splitlines():
-        if line.startswith(">") or line.startswith("~"):
+# Finds the ACK in a line. A NACK anywhere in the line takes precedence,
+# followed by an ACK with a commit hash, and then an ACK without one. Every
+# alternative starts at an "ACK" so the line is only scanned once. Since "."
+# doesn't match newlines, the whole comment can be searched at once and the
+# first match will be the ACK of the first line containing one.
+ACK_PATTERN = re.compile(
+    r"ACK(?:(?P<nack>(?<=\bNACK)\b|(?=.*?\bNACK\b))|.*?(?P<commit>[0-9a-f]{6,40})\b|\b)"
+)
+
+
+# acks only gets entries for the types of ACK that are found, and ackers maps
+# each user in acks to the type of ACK they are listed under
+def extract_acks(
+    user: str,
+    text: str,
+    acks: DefaultDict[str, Dict[str, str]],
+    head_abbrev: str,
+    ackers: Dict[str, str],
+) -> None:
+    # Most comments don't contain an ACK at all, skip those without searching
+    if "ACK" not in text:
+        return
+    pos = 0
+    while match := ACK_PATTERN.search(text, pos):
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        line_end = text.find("\n", match.end())
+        if line_end == -1:
+            line_end = len(text)
+
+        # Skip quoted lines
+        if text.startswith((">", "~"), line_start):
+            pos = line_end
             continue
-        for pattern, ack_type in ACK_PATTERNS:
-            match = pattern.search(line)
-            if match:
-                groups = match.groups()
 
-                # Remove any previous acks from this user
-                for _, existing_acks in acks.items():
-                    existing_acks.pop(user, None)
+        line = text[line_start:line_end].removesuffix("\r")
 
-                if len(groups) > 1 and groups[1][0:6] != head_abbrev:
-                    acks["Stale ACKs"][user] = line
-                else:
-                    acks[ack_type][user] = line
-                return
+        # Remove any previous acks from this user
+        if user in ackers:
+            del acks[ackers[user]][user]
 
+        if match["nack"] is not None:
+            ack_type = "NACKs"
+        elif match["commit"] is None:
+            ack_type = "Concept ACKs"
+        elif match["commit"][0:6] != head_abbrev:
+            ack_type = "Stale ACKs"
+        else:
+            ack_type = "ACKs"
+        acks[ack_type][user] = line
+        ackers[user] = ack_type
+        return
 
-def graphql_request(query: str, variables: Dict[str, str]) -> Any:
+
+def graphql_request(query: str, variables: Dict[str, Any]) -> Any:
+    global rate_limit_reset
     while True:
-        res = requests.post(
+        # Wait for the rate limit to reset rather than have the request fail
+        with rate_limit_lock:
+            reset_at = rate_limit_reset
+        if reset_at is not None:
+            stop_fetching.wait(
+                max((reset_at - datetime.now(timezone.utc)).total_seconds(), 0)
+            )
+        if stop_fetching.is_set():
+            raise Exception("Fetching was stopped")
+
+        res = session.post(
             "https://api.github.com/graphql",
             json={"query": query, "variables": variables},
-            headers=headers,
         )
         if res.ok:
-            return res.json()
+            result = res.json()
+            # If the requests that may already be in flight, plus this one's
+            # next page, could run out the rate limit, hold new requests until
+            # it resets. Responses can arrive out of order, so the hold is only
+            # lifted once the reset time has actually passed.
+            rate_limit = (result.get("data") or {}).get("rateLimit")
+            if rate_limit:
+                now = datetime.now(timezone.utc)
+                with rate_limit_lock:
+                    if rate_limit["remaining"] < rate_limit["cost"] * (MAX_WORKERS + 1):
+                        reset_at = datetime.strptime(
+                            rate_limit["resetAt"], "%Y-%m-%dT%H:%M:%SZ"
+                        ).replace(tzinfo=timezone.utc)
+                        if rate_limit_reset is None or reset_at > rate_limit_reset:
+                            rate_limit_reset = reset_at
+                    elif rate_limit_reset is not None and now >= rate_limit_reset:
+                        rate_limit_reset = None
+            return result
         if res.status_code == 502:
             # 502 is a server error, wait a bit and try again
-            time.sleep(10)
+            stop_fetching.wait(10)
             continue
         raise Exception(
             f"Result: {res}, Content: {res.content!r}, Headers: {res.headers}"
         )
 
 
-def get_pr_infos(stdscr: curses.window) -> List[PrInfo]:
-    pr_infos: List[PrInfo] = []
-    pr_query_vars: Dict[str, str] = repo_vars.copy()
+# Fetches the next page of comments for each (PR number, cursor) pair given
+def fetch_comments(pending: List[Tuple[int, str]]) -> Dict[int, Any]:
+    comments_query_vars: Dict[str, Any] = repo_vars.copy()
+    for i, (pr_num, comments_cursor) in enumerate(pending):
+        comments_query_vars[f"comments_cursor{i}"] = comments_cursor
+        comments_query_vars[f"pr_num{i}"] = pr_num
+    comments_query_res = graphql_request(
+        batched_comments_query(len(pending)), comments_query_vars
+    )
+    repository = comments_query_res["data"]["repository"]
+    return {
+        pr_num: repository[f"pr{i}"]["timelineItems"]
+        for i, (pr_num, _) in enumerate(pending)
+    }
+
+
+def show_status(stdscr: curses.window, status: str) -> None:
+    stdscr.clear()
+    stdscr.addstr(status)
+    stdscr.refresh()
+
+
+# Shows the status until at least one of the futures is done, and returns those
+# that are. Also shows when requests are waiting for the rate limit to reset, so
+# that a long wait doesn't look like a hang.
+def wait_with_status(
+    stdscr: curses.window,
+    status: str,
+    futures: Iterable[concurrent.futures.Future[Any]],
+) -> Set[concurrent.futures.Future[Any]]:
+    shown = None
     while True:
-        stdscr.clear()
-        stdscr.addstr(
-            f"Fetching PRs from GitHub, this may take a while... ({len(pr_infos)} PRs loaded)"
+        with rate_limit_lock:
+            reset_at = rate_limit_reset
+        if reset_at is not None and reset_at > datetime.now(timezone.utc):
+            text = f"{status}\nRate limited, resuming at {reset_at.astimezone():%H:%M}"
+        else:
+            text = status
+        if text != shown:
+            show_status(stdscr, text)
+            shown = text
+
+        done, _ = concurrent.futures.wait(
+            futures, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED
         )
-        stdscr.refresh()
+        if done:
+            return done
+
+
+# Finds the ACKs in a PR's comments and reviews, given in the order they were made
+def find_acks(pr: Any, comments: List[Any]) -> Acks:
+    acks: DefaultDict[str, Dict[str, str]] = defaultdict(dict)
+    ackers: Dict[str, str] = {}
+    head_abbrev = pr["headRefOid"][0:6]
+    author = pr["author"]["login"]
+    for comment in comments:
+        if comment["author"] is None:
+            continue
+        user = sys.intern(comment["author"]["login"])
+        if user == "DrahtBot" or user == author:
+            continue
+        extract_acks(user, comment["body"], acks, head_abbrev, ackers)
+    return acks
+
+
+def make_pr_info(pr: Any, acks: Acks) -> PrInfo:
+    labels = []
+    needs_rebase = False
+    for n in pr["labels"]["nodes"]:
+        # The same few labels, authors, and ackers are shared by many PRs, so
+        # they are interned (here, in find_acks, and in open_cache) to keep
+        # only one copy of each
+        labels.append(sys.intern(n["name"]))
+        if n["name"] == "Needs rebase":
+            needs_rebase = True
+    return PrInfo(
+        number=pr["number"],
+        title=pr["title"],
+        labels=labels,
+        author=sys.intern(pr["author"]["login"]),
+        acks=acks,
+        draft=pr["isDraft"],
+        needs_rebase=needs_rebase,
+        url=pr["url"],
+    )
 
-        pr_query_res = graphql_request(prs_query, pr_query_vars)
-        pr_list = pr_query_res["data"]["repository"]["pullRequests"]["nodes"]
-        pr_page_info = pr_query_res["data"]["repository"]["pullRequests"]["pageInfo"]
-
-        for pr in pr_list:
-            acks: Dict[str, Dict[str, str]] = {
-                "ACKs": {},
-                "Stale ACKs": {},
-                "NACKs": {},
-                "Approach ACKs": {},
-                "Concept ACKs": {},
-                "Other ACKs": {},
-            }
-            number = pr["number"]
-            head_commit = pr["headRefOid"]
-            head_abbrev = head_commit[0:6]
-            author = pr["author"]["login"]
-
-            # Process comments and reviews, paginating as needed
-            comments = pr["timelineItems"]["nodes"]
-            comments_page_info = pr["timelineItems"]["pageInfo"]
-            while True:
-                for comment in comments:
-                    if (
-                        comment["author"] is None
-                        or comment["author"]["login"] == "DrahtBot"
-                        or comment["author"]["login"] == author
-                    ):
-                        continue
-                    extract_acks(
-                        comment["author"]["login"], comment["body"], acks, head_abbrev
-                    )
-
-                if not comments_page_info["hasNextPage"]:
-                    break
 
-                comments_query_vars = {
-                    "comments_cursor": comments_page_info["endCursor"],
-                    "pr_num": number,
-                }
-                comments_query_vars.update(repo_vars)
-                comments_query_res = graphql_request(
-                    comments_query, comments_query_vars
+def intern_keys(pairs: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    return {sys.intern(key): value for key, value in pairs}
+
+
+# The ACKs of a PR can only change if it has been updated or pushed to, so PRs
+# that are in the cache with the same head and update time can reuse the ACKs
+# from last time and skip fetching and scanning their comments. Each repository
+# has its own cache, keyed by PR number.
+#
+# The cache is locked until the with block is left. If another ackboard has it
+# locked, or it can't be read, the connection is None and PRs are fetched
+# without the cache.
+@contextlib.contextmanager
+def open_cache() -> (
+    Iterator[Tuple[Optional[sqlite3.Connection], Dict[int, CacheEntry]]]
+):
+    path = os.path.join(
+        CACHE_DIR, f"{repo_vars['repo_owner']}_{repo_vars['repo_name']}.sqlite3"
+    )
+    cache = None
+    entries: Dict[int, CacheEntry] = {}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cache = sqlite3.connect(path, timeout=0, isolation_level=None)
+        cache.execute("BEGIN EXCLUSIVE")
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS acks (number INTEGER PRIMARY KEY, head TEXT NOT NULL, updated_at TEXT NOT NULL, acks TEXT NOT NULL)"
+        )
+        if cache.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+            cache.execute("DELETE FROM acks")
+            cache.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        for number, head, updated_at, acks in cache.execute(
+            "SELECT number, head, updated_at, acks FROM acks"
+        ):
+            entries[number] = (
+                (head, updated_at),
+                json.loads(acks, object_pairs_hook=intern_keys),
+            )
+    except (sqlite3.Error, OSError, ValueError):
+        if cache is not None:
+            cache.close()
+        cache = None
+        entries = {}
+
+    try:
+        yield cache, entries
+    finally:
+        # Closing without save_cache leaves the cache as it was
+        if cache is not None:
+            cache.close()
+
+
+# Stores the ACKs of PRs that were fetched and drops PRs that are no longer open
+def save_cache(
+    cache: sqlite3.Connection, updated: Dict[int, CacheEntry], closed: Set[int]
+) -> None:
+    # The cache only saves time, so failing to write it is not an error
+    try:
+        cache.executemany(
+            "DELETE FROM acks WHERE number = ?", [(number,) for number in closed]
+        )
+        cache.executemany(
+            "INSERT OR REPLACE INTO acks VALUES (?, ?, ?, ?)",
+            [
+                (number, head, updated_at, json.dumps(acks))
+                for number, ((head, updated_at), acks) in updated.items()
+            ],
+        )
+        cache.execute("COMMIT")
+    except sqlite3.Error:
+        pass
+
+
+# A ThreadPoolExecutor for the fetch requests. If the with block fails, requests
+# that haven't been started yet are cancelled rather than all being sent before
+# the error gets through.
+@contextlib.contextmanager
+def fetch_executor() -> Iterator[concurrent.futures.ThreadPoolExecutor]:
+    stop_fetching.clear()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        try:
+            yield executor
+        except BaseException:
+            # Also wake up requests waiting on the rate limit, so that leaving
+            # the with block doesn't wait for it to reset
+            stop_fetching.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def get_pr_infos(stdscr: curses.window) -> List[PrInfo]:
+    prs: List[Any] = []
+    pr_infos: Dict[int, PrInfo] = {}
+    more_comments: Dict[int, List[Any]] = {}
+    pending: List[Tuple[int, str]] = []
+    in_flight: Set[concurrent.futures.Future[Dict[int, Any]]] = set()
+    pr_query_vars: Dict[str, Any] = repo_vars.copy()
+    # ACKs found this time, to be written to the cache
+    updated: Dict[int, CacheEntry] = {}
+
+    with open_cache() as (cache, cached), fetch_executor() as executor:
+        # Each page of PRs is processed while the next one is being fetched
+        next_page: Optional[concurrent.futures.Future[Any]] = executor.submit(
+            graphql_request, prs_query, pr_query_vars.copy()
+        )
+        while next_page is not None:
+            wait_with_status(
+                stdscr,
+                f"Fetching PRs from GitHub, this may take a while... ({len(prs)} PRs loaded)",
+                [next_page],
+            )
+            pr_query_res = next_page.result()
+            pr_list = pr_query_res["data"]["repository"]["pullRequests"]["nodes"]
+            pr_page_info = pr_query_res["data"]["repository"]["pullRequests"][
+                "pageInfo"
+            ]
+
+            if pr_page_info["hasNextPage"]:
+                pr_query_vars["prs_cursor"] = pr_page_info["endCursor"]
+                next_page = executor.submit(
+                    graphql_request, prs_query, pr_query_vars.copy()
                 )
-                comments = comments_query_res["data"]["repository"]["pullRequest"][
-                    "timelineItems"
-                ]["nodes"]
-                comments_page_info = comments_query_res["data"]["repository"][
-                    "pullRequest"
-                ]["timelineItems"]["pageInfo"]
-
-            labels = [n["name"] for n in pr["labels"]["nodes"]]
-            pr_infos.append(
-                PrInfo(
-                    number=number,
-                    title=pr["title"],
-                    labels=labels,
-                    author=author,
-                    acks=acks,
-                    draft=pr["isDraft"],
-                    needs_rebase="Needs rebase" in labels,
-                    url=pr["url"],
+            else:
+                next_page = None
+
+            for pr in pr_list:
+                number = pr["number"]
+                entry = cached.get(number)
+                if entry is not None and entry[0] == (
+                    pr["headRefOid"],
+                    pr["updatedAt"],
+                ):
+                    pr_infos[number] = make_pr_info(pr, entry[1])
+                    continue
+
+                # PRs with more comments than fit in the first page have the rest
+                # fetched in the background and are processed once that is done
+                comments_page_info = pr["timelineItems"]["pageInfo"]
+                if comments_page_info["hasNextPage"]:
+                    more_comments[number] = []
+                    pending.append((number, comments_page_info["endCursor"]))
+                    continue
+
+                acks = find_acks(pr, pr["timelineItems"]["nodes"])
+                updated[number] = ((pr["headRefOid"], pr["updatedAt"]), acks)
+                pr_infos[number] = make_pr_info(pr, acks)
+            while len(pending) >= COMMENTS_BATCH_SIZE:
+                in_flight.add(
+                    executor.submit(fetch_comments, pending[:COMMENTS_BATCH_SIZE])
                 )
+                del pending[:COMMENTS_BATCH_SIZE]
+            prs.extend(pr_list)
+
+        # Keep requesting comments until every PR has reached its last page
+        num_loaded = 0
+        while pending or in_flight:
+            while pending:
+                in_flight.add(
+                    executor.submit(fetch_comments, pending[:COMMENTS_BATCH_SIZE])
+                )
+                del pending[:COMMENTS_BATCH_SIZE]
+
+            done = wait_with_status(
+                stdscr,
+                f"Fetching comments from GitHub, this may take a while... ({num_loaded}/{len(more_comments)} PRs loaded)",
+                in_flight,
             )
+            in_flight -= done
+            for future in done:
+                for pr_num, timeline in future.result().items():
+                    more_comments[pr_num].extend(timeline["nodes"])
+                    if timeline["pageInfo"]["hasNextPage"]:
+                        pending.append((pr_num, timeline["pageInfo"]["endCursor"]))
+                    else:
+                        num_loaded += 1
+
+        for pr in prs:
+            number = pr["number"]
+            if number in more_comments:
+                acks = find_acks(
+                    pr, pr["timelineItems"]["nodes"] + more_comments[number]
+                )
+                updated[number] = ((pr["headRefOid"], pr["updatedAt"]), acks)
+                pr_infos[number] = make_pr_info(pr, acks)
+
+        if cache is not None:
+            # Drop PRs that have been closed since the last run
+            save_cache(cache, updated, cached.keys() - {pr["number"] for pr in prs})
+        return [pr_infos[pr["number"]] for pr in prs]
+
+
+# Key functions for sorting by each type of ACK. Each returns PrInfo.ack_counts
+# reordered so that the count of that type of ACK comes first.
+ACK_KEY_FUNCS: Dict[str, Callable[[PrInfo], Tuple[int, int, int, int]]] = {
+    "ACKs": lambda info: info.ack_counts,
+    "Stale ACKs": lambda info: (
+        info.ack_counts[1],
+        info.ack_counts[0],
+        info.ack_counts[2],
+        info.ack_counts[3],
+    ),
+    "NACKs": lambda info: (
+        info.ack_counts[2],
+        info.ack_counts[0],
+        info.ack_counts[1],
+        info.ack_counts[3],
+    ),
+    "Concept ACKs": lambda info: (
+        info.ack_counts[3],
+        info.ack_counts[0],
+        info.ack_counts[1],
+        info.ack_counts[2],
+    ),
+}
 
-        pr_query_vars["prs_cursor"] = pr_page_info["endCursor"]
-        if not pr_page_info["hasNextPage"]:
-            break
-    return pr_infos
-
-
-# Key function. Returns tuple containing (num acks, num stale acks, num nacks, num approch acks, num concept acks, num other acks)
-def ack_key_func(primary_sort_key: str, info: PrInfo) -> Tuple[int, int, int, int]:
-    acks = info.acks
-    order = [
-        "ACKs",
-        "Stale ACKs",
-        "NACKs",
-        "Concept ACKs",
-    ]
-    order.insert(0, order.pop(order.index(primary_sort_key)))
-    return (
-        len(acks[order[0]]),
-        len(acks[order[1]]),
-        len(acks[order[2]]),
-        len(acks[order[3]]),
-    )
+
+# Sort commands and the type of ACK each one sorts by
+SORT_COMMANDS = {
+    "sa": "ACKs",
+    "ss": "Stale ACKs",
+    "sn": "NACKs",
+    "sc": "Concept ACKs",
+}
 
 
 def str_to_width(item: str, width: int, padding: int = 4, ellipsis: str = "…") -> str:
@@ -295,6 +673,54 @@ def str_to_width(item: str, width: int, padding: int = 4, ellipsis: str = "…")
     return f"{item_str:{width}}"
 
 
+# Column widths of the PR table and its header line
+@dataclass(slots=True)
+class Layout:
+    pr_num_cols: int
+    title_cols: int
+    author_cols: int
+    labels_cols: int
+    acks_cols: int
+    nacks_cols: int
+    stale_acks_cols: int
+    concept_acks_cols: int
+    header: str
+
+
+def recompute_layout(cols: int) -> Layout:
+    pr_num_cols = 10
+    title_cols = int(cols * 0.2)
+    labels_cols = int(cols * 0.1)
+    author_cols = int(cols * 0.05)
+
+    all_acks_cols = cols - pr_num_cols - title_cols - labels_cols - author_cols
+    acks_cols = int(all_acks_cols * 0.3)
+    stale_acks_cols = int(all_acks_cols * 0.3)
+    nacks_cols = int(all_acks_cols * 0.2)
+    concept_acks_cols = int(all_acks_cols * 0.2)
+
+    pr_num_header = str_to_width("PR", pr_num_cols)
+    title_header = str_to_width("Title", title_cols)
+    author_header = str_to_width("Author", author_cols)
+    labels_header = str_to_width("Labels", labels_cols)
+    acks_header = str_to_width("ACKs", acks_cols)
+    nacks_header = str_to_width("NACKs", nacks_cols)
+    stale_header = str_to_width("Stale Acks", stale_acks_cols)
+    concept_header = str_to_width("Concept", concept_acks_cols)
+
+    return Layout(
+        pr_num_cols=pr_num_cols,
+        title_cols=title_cols,
+        author_cols=author_cols,
+        labels_cols=labels_cols,
+        acks_cols=acks_cols,
+        nacks_cols=nacks_cols,
+        stale_acks_cols=stale_acks_cols,
+        concept_acks_cols=concept_acks_cols,
+        header=f"{pr_num_header}{title_header}{author_header}{labels_header}{acks_header}{nacks_header}{stale_header}{concept_header}",
+    )
+
+
 def detailed_pr_info(pad: curses.window, pr_info: PrInfo) -> None:
     lines, cols = pad.getmaxyx()
     lines -= 2
@@ -308,28 +734,32 @@ def detailed_pr_info(pad: curses.window, pr_info: PrInfo) -> None:
     text_lines.append(f"Number: {pr_info.number}")
     text_lines.append(f"Title: {pr_info.title}")
     text_lines.append(f"Author: {pr_info.author}")
-    text_lines.append(f"Labels: {', '.join(pr_info.labels)}")
+    text_lines.append(f"Labels: {pr_info.labels_joined}")
 
-    for ack_type, acks in pr_info.acks.items():
+    for ack_type in ACK_TYPES:
+        acks = pr_info.acks.get(ack_type, {})
         text_lines.append(f"{ack_type}: {len(acks)}")
         for acker, ack in acks.items():
             text_lines.append(f"  {acker}: {ack}")
 
-    max_width = max([len(line) for line in text_lines])
+    max_width = max(map(len, text_lines))
     shift = 0
     show_top = 0
+    redraw = True
 
     while True:
-        pad.clear()
-        for i in range(lines):
-            if show_top + i >= len(text_lines):
-                break
-            pad.addstr(i + 1, 1, text_lines[show_top + i][shift : shift + cols])
+        if redraw:
+            pad.clear()
+            for i in range(lines):
+                if show_top + i >= len(text_lines):
+                    break
+                pad.addstr(i + 1, 1, text_lines[show_top + i][shift : shift + cols])
 
-        pad.box()
-        pad.refresh()
+            pad.box()
+            pad.refresh()
 
         key = pad.getch()
+        prev_view = (show_top, shift)
         if key == ord("q"):
             pad.clear()
             pad.refresh()
@@ -353,9 +783,17 @@ def detailed_pr_info(pad: curses.window, pr_info: PrInfo) -> None:
         elif key == ord("o"):
             webbrowser.open(pr_info.url)
 
+        # Keys that don't scroll the text, such as j at the bottom, leave the
+        # pad as it is. A resize or the browser may have messed up the terminal
+        # though.
+        redraw = (show_top, shift) != prev_view or key in [
+            curses.KEY_RESIZE,
+            ord("o"),
+        ]
+
 
 def apply_filter(sorted_pr_infos: List[PrInfo], pr_filter: Filter) -> List[PrInfo]:
-    reg = re.compile(pr_filter.regex.lower())
+    reg = pr_filter.pattern
     out = []
     for pr_info in sorted_pr_infos:
         if not pr_filter.draft and pr_info.draft:
@@ -365,26 +803,8 @@ def apply_filter(sorted_pr_infos: List[PrInfo], pr_filter: Filter) -> List[PrInf
         elif not pr_filter.regular:
             continue
 
-        to_search = []
-        if pr_filter.apply == "p":
-            to_search.append(str(pr_info.number))
-        elif pr_filter.apply == "t":
-            to_search.append(pr_info.title)
-        elif pr_filter.apply == "o":
-            to_search.append(pr_info.author)
-        elif pr_filter.apply == "l":
-            to_search.extend(pr_info.labels)
-        elif pr_filter.apply == "a":
-            to_search.extend(pr_info.acks["ACKs"].keys())
-        elif pr_filter.apply == "s":
-            to_search.extend(pr_info.acks["Stale ACKs"].keys())
-        elif pr_filter.apply == "n":
-            to_search.extend(pr_info.acks["NACKs"].keys())
-        elif pr_filter.apply == "c":
-            to_search.extend(pr_info.acks["Concept ACKs"].keys())
-
-        for s in to_search:
-            match = reg.search(s.lower())
+        for s in pr_info.search_fields.get(pr_filter.apply, []):
+            match = reg.search(s)
             if match:
                 out.append(pr_info)
                 break
@@ -392,14 +812,53 @@ def apply_filter(sorted_pr_infos: List[PrInfo], pr_filter: Filter) -> List[PrInf
     return out
 
 
+# Keys that move the cursor in the PR table, see move_cursor
+MOVE_KEYS = [
+    ord("j"),
+    curses.KEY_DOWN,
+    ord("k"),
+    curses.KEY_UP,
+    curses.KEY_NPAGE,
+    curses.KEY_PPAGE,
+    ord("g"),
+    ord("G"),
+]
+
+
+# Returns the new cursor position and top line of the PR table after a key in MOVE_KEYS
+def move_cursor(
+    key: int, cursor_pos: int, show_top: int, lines: int, num_items: int
+) -> Tuple[int, int]:
+    show_range = lines - 2
+    if key in [ord("j"), curses.KEY_DOWN]:
+        if cursor_pos == lines - 2:
+            show_top = min(show_top + 1, max(num_items - show_range, 0))
+        cursor_pos = min(cursor_pos + 1, lines - 2, num_items)
+    elif key in [ord("k"), curses.KEY_UP]:
+        if cursor_pos == 1:
+            show_top = max(show_top - 1, 0)
+        cursor_pos = max(cursor_pos - 1, 1)
+    elif key == curses.KEY_NPAGE:
+        show_top = min(show_top + show_range, max(num_items - show_range, 0))
+    elif key == curses.KEY_PPAGE:
+        show_top = max(show_top - show_range, 0)
+    elif key == ord("g"):
+        cursor_pos = 1
+        show_top = 0
+    elif key == ord("G"):
+        cursor_pos = lines - 2
+        show_top = max(num_items - show_range, 0)
+    return cursor_pos, show_top
+
+
 def main(stdscr: curses.window) -> None:
 
+    # pr_infos is kept sorted by sort_key, sorted_pr_infos is what is displayed
     pr_infos = get_pr_infos(stdscr)
     sort_key = "ACKs"
     pr_filter = Filter()
-    sorted_pr_infos = sorted(
-        pr_infos, key=functools.partial(ack_key_func, sort_key), reverse=True
-    )
+    pr_infos.sort(key=ACK_KEY_FUNCS[sort_key], reverse=True)
+    sorted_pr_infos = apply_filter(pr_infos, pr_filter)
 
     stdscr.clear()
     lines, cols = stdscr.getmaxyx()
@@ -407,43 +866,36 @@ def main(stdscr: curses.window) -> None:
     show_top = 0
     cursor_pos = 1
 
+    layout = recompute_layout(cols)
+    # Rendered table rows by PR number, only valid for the current cols
+    row_cache: Dict[int, str] = {}
+    # Whether the whole table needs to be drawn, or only the lines the cursor
+    # moved between
+    redraw = True
+    prev_cursor_pos = cursor_pos
+
     curses.init_pair(1, curses.COLOR_BLUE, curses.COLOR_BLACK)
     curses.init_pair(2, curses.COLOR_CYAN, curses.COLOR_BLACK)
 
     while True:
-        pr_num_cols = 10
-        title_cols = int(cols * 0.2)
-        labels_cols = int(cols * 0.1)
-        author_cols = int(cols * 0.05)
-
-        all_acks_cols = cols - pr_num_cols - title_cols - labels_cols - author_cols
-        acks_cols = int(all_acks_cols * 0.3)
-        stale_acks_cols = int(all_acks_cols * 0.3)
-        nacks_cols = int(all_acks_cols * 0.2)
-        concept_acks_cols = int(all_acks_cols * 0.2)
-
-        pr_num_header = str_to_width("PR", pr_num_cols)
-        title_header = str_to_width("Title", title_cols)
-        author_header = str_to_width("Author", author_cols)
-        labels_header = str_to_width("Labels", labels_cols)
-        acks_header = str_to_width("ACKs", acks_cols)
-        nacks_header = str_to_width("NACKs", nacks_cols)
-        stale_header = str_to_width("Stale Acks", stale_acks_cols)
-        concept_header = str_to_width("Concept", concept_acks_cols)
-
-        stdscr.addstr(
-            0,
-            0,
-            f"{pr_num_header}{title_header}{author_header}{labels_header}{acks_header}{nacks_header}{stale_header}{concept_header}",
-            curses.A_BOLD,
-        )
+        if redraw:
+            stdscr.addstr(
+                0,
+                0,
+                layout.header,
+                curses.A_BOLD,
+            )
+            rows_to_draw = list(range(show_range))
+        else:
+            rows_to_draw = [prev_cursor_pos - 1, cursor_pos - 1]
 
         num_items = len(sorted_pr_infos)
-        for i in range(show_range):
+        for i in rows_to_draw:
             pr_i = show_top + i
             line_pos = 1 + i
-            if pr_i >= len(sorted_pr_infos):
-                break
+            # With nothing to show, the cursor is on line 0 and i can be -1
+            if not 0 <= pr_i < len(sorted_pr_infos):
+                continue
 
             pr_info = sorted_pr_infos[pr_i]
 
@@ -455,65 +907,58 @@ def main(stdscr: curses.window) -> None:
             elif pr_info.needs_rebase:
                 attrs |= curses.color_pair(2)
 
-            pr_num_str = str_to_width(str(pr_info.number), pr_num_cols)
-            title_str = str_to_width(pr_info.title, title_cols)
-            author_str = str_to_width(pr_info.author, author_cols)
-            labels_str = str_to_width(", ".join(pr_info.labels), labels_cols)
-            acks_str = str_to_width(
-                f"({len(pr_info.acks['ACKs'])}) "
-                + ", ".join(pr_info.acks["ACKs"].keys()),
-                acks_cols,
-            )
-            nacks_str = str_to_width(
-                f"({len(pr_info.acks['NACKs'])}) "
-                + ", ".join(pr_info.acks["NACKs"].keys()),
-                nacks_cols,
-            )
-            stale_str = str_to_width(
-                f"({len(pr_info.acks['Stale ACKs'])}) "
-                + ", ".join(pr_info.acks["Stale ACKs"].keys()),
-                stale_acks_cols,
-            )
-            concept_str = str_to_width(
-                f"({len(pr_info.acks['Concept ACKs'])}) "
-                + ", ".join(pr_info.acks["Concept ACKs"].keys()),
-                concept_acks_cols,
-            )
+            if pr_info.number not in row_cache:
+                pr_num_str = str_to_width(str(pr_info.number), layout.pr_num_cols)
+                title_str = str_to_width(pr_info.title, layout.title_cols)
+                author_str = str_to_width(pr_info.author, layout.author_cols)
+                labels_str = str_to_width(pr_info.labels_joined, layout.labels_cols)
+                acks_str = str_to_width(pr_info.acks_joined["ACKs"], layout.acks_cols)
+                nacks_str = str_to_width(
+                    pr_info.acks_joined["NACKs"], layout.nacks_cols
+                )
+                stale_str = str_to_width(
+                    pr_info.acks_joined["Stale ACKs"], layout.stale_acks_cols
+                )
+                concept_str = str_to_width(
+                    pr_info.acks_joined["Concept ACKs"], layout.concept_acks_cols
+                )
+                row_cache[
+                    pr_info.number
+                ] = f"{pr_num_str}{title_str}{author_str}{labels_str}{acks_str}{nacks_str}{stale_str}{concept_str}"
 
-            stdscr.addstr(
-                line_pos,
-                0,
-                f"{pr_num_str}{title_str}{author_str}{labels_str}{acks_str}{nacks_str}{stale_str}{concept_str}",
-                attrs,
-            )
+            stdscr.addstr(line_pos, 0, row_cache[pr_info.number], attrs)
 
         stdscr.move(lines - 1, 0)
         stdscr.refresh()
 
         key = stdscr.getch()
-        if key in [ord("j"), curses.KEY_DOWN]:
-            if cursor_pos == lines - 2:
-                show_top = min(show_top + 1, max(num_items - show_range, 0))
-            cursor_pos = min(cursor_pos + 1, lines - 2, num_items)
-        elif key in [ord("k"), curses.KEY_UP]:
-            if cursor_pos == 1:
-                show_top = max(show_top - 1, 0)
-            cursor_pos = max(cursor_pos - 1, 1)
-        elif key == curses.KEY_NPAGE:
-            show_top = min(show_top + show_range, max(num_items - show_range, 0))
-        elif key == curses.KEY_PPAGE:
-            show_top = max(show_top - show_range, 0)
-        elif key == ord("g"):
-            cursor_pos = 1
-            show_top = 0
-        elif key == ord("G"):
-            cursor_pos = lines - 2
-            show_top = max(num_items - show_range, 0)
+        redraw = True
+        prev_cursor_pos = cursor_pos
+        prev_show_top = show_top
+        if key in MOVE_KEYS:
+            cursor_pos, show_top = move_cursor(
+                key, cursor_pos, show_top, lines, num_items
+            )
+
+            # When keys are held down or repeated, apply all of the moves that
+            # are already waiting before drawing again
+            stdscr.nodelay(True)
+            while (key := stdscr.getch()) in MOVE_KEYS:
+                cursor_pos, show_top = move_cursor(
+                    key, cursor_pos, show_top, lines, num_items
+                )
+            if key != -1:
+                curses.ungetch(key)
+            stdscr.nodelay(False)
+
+            redraw = show_top != prev_show_top
         elif key == curses.KEY_RESIZE:
             lines, cols = stdscr.getmaxyx()
             show_range = lines - 2
             show_top = min(show_top, max(num_items - show_range, 0))
             cursor_pos = min(cursor_pos, lines - 2)
+            layout = recompute_layout(cols)
+            row_cache.clear()
 
             stdscr.erase()
         elif key == ord("d"):
@@ -537,36 +982,13 @@ def main(stdscr: curses.window) -> None:
                 break
             elif cmd == "r":
                 pr_infos = get_pr_infos(stdscr)
-                sorted_pr_infos = sorted(
-                    pr_infos,
-                    key=functools.partial(ack_key_func, sort_key),
-                    reverse=True,
-                )
-                sorted_pr_infos = apply_filter(sorted_pr_infos, pr_filter)
-            elif cmd == "sa":
-                sort_key = "ACKs"
-                sorted_pr_infos.sort(
-                    key=functools.partial(ack_key_func, sort_key),
-                    reverse=True,
-                )
-            elif cmd == "ss":
-                sort_key = "Stale ACKs"
-                sorted_pr_infos.sort(
-                    key=functools.partial(ack_key_func, sort_key),
-                    reverse=True,
-                )
-            elif cmd == "sn":
-                sort_key = "NACKs"
-                sorted_pr_infos.sort(
-                    key=functools.partial(ack_key_func, sort_key),
-                    reverse=True,
-                )
-            elif cmd == "sc":
-                sort_key = "Concept ACKs"
-                sorted_pr_infos.sort(
-                    key=functools.partial(ack_key_func, sort_key),
-                    reverse=True,
-                )
+                row_cache.clear()
+                pr_infos.sort(key=ACK_KEY_FUNCS[sort_key], reverse=True)
+                sorted_pr_infos = apply_filter(pr_infos, pr_filter)
+            elif cmd in SORT_COMMANDS:
+                sort_key = SORT_COMMANDS[cmd]
+                pr_infos.sort(key=ACK_KEY_FUNCS[sort_key], reverse=True)
+                sorted_pr_infos.sort(key=ACK_KEY_FUNCS[sort_key], reverse=True)
             elif cmd == "sr":
                 random.shuffle(sorted_pr_infos)
             elif cmd.startswith("f") and len(cmd) > 3 and cmd[2] == "/":
@@ -590,12 +1012,7 @@ def main(stdscr: curses.window) -> None:
                 else:
                     continue
 
-                sorted_pr_infos = sorted(
-                    pr_infos,
-                    key=functools.partial(ack_key_func, sort_key),
-                    reverse=True,
-                )
-                sorted_pr_infos = apply_filter(sorted_pr_infos, pr_filter)
+                sorted_pr_infos = apply_filter(pr_infos, pr_filter)
 
                 cursor_pos = 1
                 stdscr.clear()
@@ -632,5 +1049,6 @@ if __name__ == "__main__":
             headers["Authorization"] = line
         else:
             headers["Authorization"] = "bearer " + line
+    session.headers.update(headers)
 
     curses.wrapper(main)